@@ -1,8 +1,17 @@
 import os
-import sqlite3
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List, Tuple
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple
 
+import aiosqlite
+
+try:
+    import uvloop  # optional: faster event loop on Linux/macOS
+except ImportError:
+    uvloop = None
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -14,107 +23,313 @@ from telegram.ext import (
     CommandHandler,
 )
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # States
 POSITION, MODE, MMR, SEARCH_MODE, SEARCH_POS_OPTION, SELECT_POSITION, SEARCH_FULL_OPTION, SEARCH_MMR = range(8)
 
 DB_FILE = "users.db"
+# Applied to every connection on open. journal_mode=WAL is stored in the
+# database file (readers don't block the writer, and with synchronous=NORMAL
+# commits only fsync at checkpoints); the rest are per-connection settings.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    # read pages straight from the mapped file instead of copying them via read()
+    "PRAGMA mmap_size=268435456",
+    # ANALYZE / PRAGMA optimize sample at most this many rows per index
+    "PRAGMA analysis_limit=1000",
+)
+# Room for the fixed statements plus every shape of the dynamic UPDATE/search SQL.
+DB_CACHED_STATEMENTS = 256
 
-POSITIONS = {
-    "1": "Carry",
-    "2": "Mid",
-    "3": "Offlane",
-    "4": "Soft Support",
-    "5": "Hard Support",
-}
+# Indexed by position number (1-5), which is also the stored code; slot 0 is unused
+POSITIONS = (None, "Carry", "Mid", "Offlane", "Soft Support", "Hard Support")
+
+# Accepted MMR range; search bounds are clamped to it as well
+MMR_MAX = 15000
 
 GAME_MODES = ["Turbo", "All Pick", "Single Draft", "Ranked"]
+VALID_MODES = frozenset(GAME_MODES)
+
+# position/mode are stored as small integer codes; names exist only in Python
+POSITION_CODES = {name: code for code, name in enumerate(POSITIONS) if name}
+POSITION_NAMES = {code: name for name, code in POSITION_CODES.items()}
+MODE_CODES = {name: code for code, name in enumerate(GAME_MODES, 1)}
+MODE_NAMES = {code: name for name, code in MODE_CODES.items()}
 
 
 # --- Database utilities ---
 
 
-def init_db():
+# Fixed statements live in module constants so every call passes the same SQL
+# text and hits sqlite3's per-connection prepared statement cache.
+SQL_SELECT_PROFILE = "SELECT user_id, position, mode, mmr, username, online, full_party FROM profiles WHERE user_id = ?"
+# Single-statement upsert: NULL parameters leave the stored value untouched.
+# RETURNING hands back the resulting row so the cache can be refreshed without a re-read.
+SQL_UPSERT_PROFILE = """
+    INSERT INTO profiles (user_id, position, mode, mmr, username, online, full_party)
+    VALUES (:user_id, :position, :mode, :mmr, :username, COALESCE(:online, 0), COALESCE(:full_party, 0))
+    ON CONFLICT(user_id) DO UPDATE SET
+        position = COALESCE(excluded.position, position),
+        mode = COALESCE(excluded.mode, mode),
+        mmr = COALESCE(excluded.mmr, mmr),
+        username = COALESCE(excluded.username, username),
+        online = COALESCE(:online, online),
+        full_party = COALESCE(:full_party, full_party)
+    RETURNING user_id, position, mode, mmr, username, online, full_party
+"""
+
+# STRICT makes SQLite enforce the column types. WITHOUT ROWID is not used:
+# user_id INTEGER PRIMARY KEY already is the rowid, so the table is clustered on it.
+SQL_CREATE_PROFILES = """
+    CREATE TABLE {if_not_exists} {table} (
+        user_id INTEGER PRIMARY KEY,
+        position INTEGER,
+        mode INTEGER,
+        mmr INTEGER,
+        username TEXT,
+        online INTEGER NOT NULL DEFAULT 0,
+        full_party INTEGER NOT NULL DEFAULT 0
+    ) STRICT
+"""
+
+
+class Profile(NamedTuple):
+    """Decoded profiles row: position/mode as names, online/full_party as bools."""
+    user_id: int
+    position: Optional[str]
+    mode: Optional[str]
+    mmr: Optional[int]
+    username: Optional[str]
+    online: bool
+    full_party: bool
+
+
+# Profiles only change through upsert_profile, so reads are served from an LRU
+# dict that upsert_profile keeps up to date (write-through).
+PROFILE_CACHE_SIZE = 10_000
+PROFILE_CACHE: "OrderedDict[int, Profile]" = OrderedDict()
+# Users known to have no profile yet -> monotonic expiry time. Kept short so a
+# row created outside the bot is picked up without a restart.
+MISSING_PROFILE_TTL = 60.0
+MISSING_PROFILES: "OrderedDict[int, float]" = OrderedDict()
+# Recent search results: (sql, *params) -> (monotonic expiry, rows). Cleared
+# whenever someone goes online/offline; other profile edits may show up to
+# SEARCH_CACHE_TTL seconds late.
+SEARCH_CACHE_SIZE = 500
+SEARCH_CACHE_TTL = 30.0
+SEARCH_CACHE: "OrderedDict[tuple, Tuple[float, list]]" = OrderedDict()
+
+# Shared aiosqlite connection, opened once by open_db() and reused by every handler.
+DB: Optional[aiosqlite.Connection] = None
+
+
+async def table_columns(table: str) -> Dict[str, str]:
+    return {row[1]: row[2] for row in await DB.execute_fetchall(f"PRAGMA table_info({table})")}
+
+
+async def init_db():
     """
-    Create table if needed and migrate schema to include new columns (mode, mmr, username, online, full_party).
+    Create table if needed and apply the schema migrations this database file
+    has not seen yet. PRAGMA user_version stores how many SCHEMA_MIGRATIONS
+    steps were applied, so an up-to-date file costs a single PRAGMA read.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS profiles (
-            user_id INTEGER PRIMARY KEY,
-            position TEXT,
-            mode TEXT,
-            mmr INTEGER,
-            username TEXT,
-            online INTEGER DEFAULT 0,
-            full_party INTEGER DEFAULT 0
-        )
-        """
-    )
-    conn.commit()
+    await DB.execute(SQL_CREATE_PROFILES.format(table="profiles", if_not_exists="IF NOT EXISTS"))
+
+    version = (await DB.execute_fetchall("PRAGMA user_version"))[0][0]
+    if version >= len(SCHEMA_MIGRATIONS):
+        return
+    # All pending steps commit together: one fsync, and a failed step rolls
+    # back to the previous user_version instead of leaving a half-migrated file.
+    # Runs from post_init, before any handler can touch the connection.
+    await DB.execute("BEGIN IMMEDIATE")
+    try:
+        for step, migrate in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+            logger.info("Миграция схемы БД: шаг %d (%s)", step, migrate.__name__)
+            await migrate()
+            await DB.execute(f"PRAGMA user_version = {step}")
+    except BaseException:
+        await DB.execute("ROLLBACK")
+        raise
+    await DB.execute("COMMIT")
+
 
-    # Migration: ensure columns exist (in case table was created before adding columns)
-    cursor.execute("PRAGMA table_info(profiles)")
-    cols = {row[1] for row in cursor.fetchall()}
+async def migrate_legacy_profiles():
+    """
+    Bring a profiles table from older releases up to SQL_CREATE_PROFILES:
+    add columns that are missing (mode, mmr, username, online, full_party),
+    then re-encode TEXT position/mode. A fresh table passes through untouched.
+    """
+    cols = await table_columns("profiles")
     if "mode" not in cols:
-        try:
-            cursor.execute("ALTER TABLE profiles ADD COLUMN mode TEXT")
-        except Exception:
-            pass
+        await DB.execute("ALTER TABLE profiles ADD COLUMN mode TEXT")
     if "mmr" not in cols:
-        try:
-            cursor.execute("ALTER TABLE profiles ADD COLUMN mmr INTEGER")
-        except Exception:
-            pass
+        await DB.execute("ALTER TABLE profiles ADD COLUMN mmr INTEGER")
     if "username" not in cols:
-        try:
-            cursor.execute("ALTER TABLE profiles ADD COLUMN username TEXT")
-        except Exception:
-            pass
+        await DB.execute("ALTER TABLE profiles ADD COLUMN username TEXT")
     if "online" not in cols:
-        try:
-            cursor.execute("ALTER TABLE profiles ADD COLUMN online INTEGER DEFAULT 0")
-            cursor.execute("UPDATE profiles SET online = 0 WHERE online IS NULL")
-        except Exception:
-            pass
+        await DB.execute("ALTER TABLE profiles ADD COLUMN online INTEGER DEFAULT 0")
+        await DB.execute("UPDATE profiles SET online = 0 WHERE online IS NULL")
     if "full_party" not in cols:
-        try:
-            cursor.execute("ALTER TABLE profiles ADD COLUMN full_party INTEGER DEFAULT 0")
-            cursor.execute("UPDATE profiles SET full_party = 0 WHERE full_party IS NULL")
-        except Exception:
-            pass
+        await DB.execute("ALTER TABLE profiles ADD COLUMN full_party INTEGER DEFAULT 0")
+        await DB.execute("UPDATE profiles SET full_party = 0 WHERE full_party IS NULL")
 
-    conn.commit()
-    conn.close()
+    # tables created before STRICT stored position/mode as TEXT names
+    if (await table_columns("profiles")).get("position", "").upper() == "TEXT":
+        await encode_profiles_table()
+
+
+async def encode_profiles_table():
+    """
+    Rebuild a legacy profiles table as STRICT with position/mode stored as
+    integer codes. Unknown names become NULL. Runs inside init_db()'s
+    migration transaction.
+    """
+    position_case = " ".join("WHEN ? THEN ?" for _ in POSITION_CODES)
+    mode_case = " ".join("WHEN ? THEN ?" for _ in MODE_CODES)
+    params = [v for name, code in POSITION_CODES.items() for v in (name, code)]
+    params += [v for name, code in MODE_CODES.items() for v in (name.lower(), code)]
+    await DB.execute(SQL_CREATE_PROFILES.format(table="profiles_new", if_not_exists=""))
+    await DB.execute(
+        "INSERT INTO profiles_new (user_id, position, mode, mmr, username, online, full_party) "
+        f"SELECT user_id, CASE position {position_case} END, CASE LOWER(mode) {mode_case} END, "
+        "CAST(mmr AS INTEGER), username, COALESCE(online, 0), COALESCE(full_party, 0) FROM profiles",
+        params,
+    )
+    await DB.execute("DROP TABLE profiles")
+    await DB.execute("ALTER TABLE profiles_new RENAME TO profiles")
 
 
-def get_profile(user_id: int) -> Optional[Dict[str, Any]]:
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id, position, mode, mmr, username, online, full_party FROM profiles WHERE user_id = ?",
-        (user_id,),
+async def create_search_indexes():
+    """
+    Covering partial indexes for the search. Every search filters on
+    online = 1, so only online rows are indexed. Each index holds every column
+    the search reads (user_id is the rowid), so it is answered without
+    touching the table. mmr ranges, mode= and position= each get their own
+    leading column. online is listed even though the WHERE pins it: SQLite
+    only treats the index as covering if the column is in it.
+    """
+    await DB.execute(
+        "CREATE INDEX IF NOT EXISTS idx_profiles_online_mmr "
+        "ON profiles(mmr, position, mode, full_party, username, online) WHERE online = 1"
+    )
+    await DB.execute(
+        "CREATE INDEX IF NOT EXISTS idx_profiles_online_mode "
+        "ON profiles(mode, position, full_party, mmr, username, online) WHERE online = 1"
+    )
+    await DB.execute(
+        "CREATE INDEX IF NOT EXISTS idx_profiles_online_position "
+        "ON profiles(position, mode, full_party, mmr, username, online) WHERE online = 1"
     )
-    row = cursor.fetchone()
-    conn.close()
+
+
+# Applied in order; append new steps, never reorder or remove them.
+SCHEMA_MIGRATIONS = (
+    migrate_legacy_profiles,
+    create_search_indexes,
+)
+
+
+async def open_db(application: Application):
+    """
+    post_init hook: open the shared connection on the running event loop,
+    then create/migrate the schema on it. The connection lives until
+    close_db() runs at shutdown.
+    """
+    global DB
+    DB = await aiosqlite.connect(DB_FILE, isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+    for pragma in DB_PRAGMAS:
+        await DB.execute(pragma)
+    await init_db()
+    # Refresh planner stats on every start. Without them SQLite picks the
+    # mode/position index for MMR searches and sorts the whole range. PRAGMA
+    # optimize is not enough here: before SQLite 3.46 it only analyzes tables
+    # this connection has already queried.
+    await DB.execute("ANALYZE")
+
+
+async def close_db(application: Application):
+    """post_shutdown hook: update planner stats the session's queries asked for, then close."""
+    global DB
+    if DB is not None:
+        await DB.execute("PRAGMA optimize")
+        await DB.close()
+        DB = None
+
+
+def cache_profile(user_id: int, profile: Profile):
+    MISSING_PROFILES.pop(user_id, None)
+    PROFILE_CACHE[user_id] = profile
+    PROFILE_CACHE.move_to_end(user_id)
+    if len(PROFILE_CACHE) > PROFILE_CACHE_SIZE:
+        PROFILE_CACHE.popitem(last=False)
+
+
+def cache_missing_profile(user_id: int):
+    MISSING_PROFILES[user_id] = time.monotonic() + MISSING_PROFILE_TTL
+    MISSING_PROFILES.move_to_end(user_id)
+    if len(MISSING_PROFILES) > PROFILE_CACHE_SIZE:
+        MISSING_PROFILES.popitem(last=False)
+
+
+def get_cached_search(key: tuple) -> Optional[list]:
+    entry = SEARCH_CACHE.get(key)
+    if entry is None:
+        return None
+    expires, rows = entry
+    if expires <= time.monotonic():
+        del SEARCH_CACHE[key]
+        return None
+    return rows
+
+
+def cache_search(key: tuple, rows: list):
+    SEARCH_CACHE[key] = (time.monotonic() + SEARCH_CACHE_TTL, rows)
+    SEARCH_CACHE.move_to_end(key)
+    if len(SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+        SEARCH_CACHE.popitem(last=False)
+
+
+def row_to_profile(row) -> Profile:
+    return Profile(
+        row[0],
+        POSITION_NAMES.get(row[1]),
+        MODE_NAMES.get(row[2]),
+        row[3],
+        row[4],
+        # NOT NULL columns, so no None check is needed
+        bool(row[5]),
+        bool(row[6]),
+    )
+
+
+async def get_profile(user_id: int) -> Optional[Profile]:
+    cached = PROFILE_CACHE.get(user_id)
+    if cached is not None:
+        PROFILE_CACHE.move_to_end(user_id)
+        return cached
+    expires = MISSING_PROFILES.get(user_id)
+    if expires is not None:
+        if expires > time.monotonic():
+            return None
+        del MISSING_PROFILES[user_id]
+
+    # execute_fetchall() is a single hop to aiosqlite's worker thread, versus
+    # three for execute() + fetchone() + cursor close
+    rows = await DB.execute_fetchall(SQL_SELECT_PROFILE, (user_id,))
+    row = rows[0] if rows else None
     if not row:
+        cache_missing_profile(user_id)
         return None
-    return {
-        "user_id": row[0],
-        "position": row[1],
-        "mode": row[2],
-        "mmr": row[3],
-        "username": row[4],
-        "online": bool(row[5]) if row[5] is not None else False,
-        "full_party": bool(row[6]) if row[6] is not None else False,
-    }
-
-
-def upsert_profile(
+    profile = row_to_profile(row)
+    cache_profile(user_id, profile)
+    return profile
+
+
+async def upsert_profile(
     user_id: int,
     position: Optional[str] = None,
     mode: Optional[str] = None,
@@ -122,53 +337,41 @@ def upsert_profile(
     username: Optional[str] = None,
     online: Optional[int] = None,
     full_party: Optional[int] = None,
-):
+) -> Profile:
     """
-    Insert or update profile fields provided (keeps other fields intact).
+    Insert or update profile fields provided (keeps other fields intact)
+    and return the resulting profile.
+    position/mode: names from POSITIONS/GAME_MODES, stored as their codes.
     online/full_party: 1 or 0 or None (if None, don't change)
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM profiles WHERE user_id = ?", (user_id,))
-    exists = cursor.fetchone() is not None
-
-    if exists:
-        fields = []
-        params = []
-        if position is not None:
-            fields.append("position = ?")
-            params.append(position)
-        if mode is not None:
-            fields.append("mode = ?")
-            params.append(mode)
-        if mmr is not None:
-            fields.append("mmr = ?")
-            params.append(mmr)
-        if username is not None:
-            fields.append("username = ?")
-            params.append(username)
-        if online is not None:
-            fields.append("online = ?")
-            params.append(1 if online else 0)
-        if full_party is not None:
-            fields.append("full_party = ?")
-            params.append(1 if full_party else 0)
-        if fields:
-            params.append(user_id)
-            sql = f"UPDATE profiles SET {', '.join(fields)} WHERE user_id = ?"
-            cursor.execute(sql, params)
-    else:
-        insert_online = 1 if online else 0
-        insert_full = 1 if full_party else 0
-        cursor.execute(
-            "INSERT INTO profiles (user_id, position, mode, mmr, username, online, full_party) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (user_id, position, mode, mmr, username, insert_online, insert_full),
-        )
-    conn.commit()
-    conn.close()
-
-
-init_db()
+    # Nothing to write if every given field already holds that value; the
+    # write-through cache is authoritative for rows it holds.
+    cached = PROFILE_CACHE.get(user_id)
+    if cached is not None and all(new is None or new == old for new, old in (
+        (position, cached.position),
+        (mode, cached.mode),
+        (mmr, cached.mmr),
+        (username, cached.username),
+        (online, cached.online),
+        (full_party, cached.full_party),
+    )):
+        PROFILE_CACHE.move_to_end(user_id)
+        return cached
+
+    rows = await DB.execute_fetchall(SQL_UPSERT_PROFILE, {
+        "user_id": user_id,
+        "position": POSITION_CODES[position] if position is not None else None,
+        "mode": MODE_CODES[mode] if mode is not None else None,
+        "mmr": mmr,
+        "username": username,
+        "online": None if online is None else bool(online),
+        "full_party": None if full_party is None else bool(full_party),
+    })
+    profile = row_to_profile(rows[0])
+    if cached is None or profile.online != cached.online:
+        SEARCH_CACHE.clear()
+    cache_profile(user_id, profile)
+    return profile
 
 
 # --- Keyboards + helpers for back stack ---
@@ -180,11 +383,33 @@ def back_and_menu_row():
             InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]
 
 
+# Static keyboards are built once; InlineKeyboardMarkup is immutable and safe to share.
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="search_party")],
+    [InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile")],
+])
+
+NEED_POSITION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Указать позицию", callback_data="edit_position")],
+    [InlineKeyboardButton("🏠 В меню", callback_data="main_menu")],
+])
+
+NEED_MMR_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Указать MMR", callback_data="edit_mmr")],
+    [InlineKeyboardButton("🏠 В меню", callback_data="main_menu")],
+])
+
+BACK_MENU_KEYBOARD = InlineKeyboardMarkup([back_and_menu_row()])
+
+EDIT_MMR_KEYBOARD = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
+    InlineKeyboardButton("🏠 В меню", callback_data="main_menu"),
+    InlineKeyboardButton("Отмена", callback_data="go_back"),
+]])
+
+
 def get_main_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔍 Искать тиммейта", callback_data="search_party")],
-        [InlineKeyboardButton("👤 Мой профиль", callback_data="my_profile")],
-    ])
+    return MAIN_KEYBOARD
 
 
 def profile_edit_keyboard_dynamic(is_online: bool, full_party: bool):
@@ -193,6 +418,12 @@ def profile_edit_keyboard_dynamic(is_online: bool, full_party: bool):
     edit buttons and back/menu row.
     Short labels to avoid truncation.
     """
+    return build_profile_edit_keyboard(bool(is_online), bool(full_party))
+
+
+@lru_cache(maxsize=4)
+def build_profile_edit_keyboard(is_online: bool, full_party: bool):
+    # only four (online, full_party) combinations exist
     online_label = "🟢 Онлайн" if is_online else "⚪ Офлайн"
     full_label = "🤝 Full: ON" if full_party else "🤝 Full: OFF"
     kb = [
@@ -206,6 +437,9 @@ def profile_edit_keyboard_dynamic(is_online: bool, full_party: bool):
     return InlineKeyboardMarkup(kb)
 
 
+# Keyboard builders decorated with lru_cache depend only on their arguments:
+# each variant is built on first use and the same markup is returned afterwards.
+@lru_cache(maxsize=None)
 def mode_selection_keyboard(action_prefix="mode_", include_back=True):
     # include an explicit "search without mode" button
     keyboard = [[InlineKeyboardButton(m, callback_data=f"{action_prefix}{m}")] for m in GAME_MODES]
@@ -217,10 +451,15 @@ def mode_selection_keyboard(action_prefix="mode_", include_back=True):
     return InlineKeyboardMarkup(keyboard)
 
 
-def search_pos_option_keyboard_dynamic(context: Dict[str, Any]):
-    exclude = context.get("exclude_position")
+def search_pos_option_keyboard_dynamic(search: Dict[str, Any]):
+    exclude = search.get("exclude_position")
     if exclude is None:
         exclude = True  # default ON
+    return build_search_pos_option_keyboard(bool(exclude))
+
+
+@lru_cache(maxsize=2)
+def build_search_pos_option_keyboard(exclude: bool):
     label = f"🚫 Искл. мою поз.: {'ON' if exclude else 'OFF'}"
     keyboard = [
         [InlineKeyboardButton(label, callback_data="toggle_exclude_position"),
@@ -231,18 +470,24 @@ def search_pos_option_keyboard_dynamic(context: Dict[str, Any]):
     return InlineKeyboardMarkup(keyboard)
 
 
-def select_position_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("1 — Carry", callback_data="selectpos_1"),
-         InlineKeyboardButton("2 — Mid", callback_data="selectpos_2")],
-        [InlineKeyboardButton("3 — Offlane", callback_data="selectpos_3"),
-         InlineKeyboardButton("4 — Soft Support", callback_data="selectpos_4")],
-        [InlineKeyboardButton("5 — Hard Support", callback_data="selectpos_5")],
-        back_and_menu_row()
-    ]
+@lru_cache(maxsize=None)
+def select_position_keyboard(action_prefix="selectpos_"):
+    buttons = [InlineKeyboardButton(f"{code} — {name}", callback_data=f"{action_prefix}{code}")
+               for code, name in enumerate(POSITIONS) if name]
+    # two buttons per row
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append(back_and_menu_row())
     return InlineKeyboardMarkup(keyboard)
 
 
+def position_by_key(key: str) -> Optional[str]:
+    """Position name for a "1".."5" key (callback data suffix or typed text), else None."""
+    if key.isascii() and key.isdecimal() and 0 < int(key) < len(POSITIONS):
+        return POSITIONS[int(key)]
+    return None
+
+
+@lru_cache(maxsize=None)
 def search_full_option_keyboard(include_back=True):
     keyboard = [
         [InlineKeyboardButton("🔒 Только Full: Да", callback_data="only_full_yes"),
@@ -255,6 +500,7 @@ def search_full_option_keyboard(include_back=True):
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=None)
 def search_mmr_keyboard():
     keyboard = [
         [InlineKeyboardButton("Не учитывать MMR", callback_data="mmr_none")],
@@ -269,24 +515,24 @@ def search_mmr_keyboard():
 
 
 def push_back(context: ContextTypes.DEFAULT_TYPE, prev: str):
-    stack = context.user_data.get("back_stack", [])
-    stack.append(prev)
-    context.user_data["back_stack"] = stack
+    context.user_data.setdefault("back_stack", []).append(prev)
 
 
 def pop_back(context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
-    stack = context.user_data.get("back_stack", [])
-    if not stack:
-        return None
-    val = stack.pop()
-    context.user_data["back_stack"] = stack
-    return val
+    # the list is mutated in place, no need to store it back
+    stack = context.user_data.get("back_stack")
+    return stack.pop() if stack else None
 
 
 def clear_back(context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("back_stack", None)
 
 
+def search_state(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
+    """Options of the search being set up; dropped as a whole by user_data.pop("search")."""
+    return context.user_data.setdefault("search", {})
+
+
 # Helper: store last displayed text for a step
 def store_last_text(context: ContextTypes.DEFAULT_TYPE, step: str, text: str):
     key = f"last_text_{step}"
@@ -297,6 +543,31 @@ def get_last_text(context: ContextTypes.DEFAULT_TYPE, step: str) -> Optional[str
     return context.user_data.get(f"last_text_{step}")
 
 
+PROFILE_HELP_TEXT = (
+    "\n\nСтатус Online/Offline:\n"
+    "Если вы включите Online — вас будут показывать в результатах поиска и вам могут написать.\n"
+    "Если выключите — вы не будете видны в поиске и вас не будут беспокоить."
+    "\n\nFull party (согласен на полную пати):\n"
+    "Если включено — вы помечены как готовый играть в полную пати."
+)
+
+
+def format_profile_text(profile: Optional[Profile]) -> str:
+    """Profile card shown by my_profile and by Back to the profile step."""
+    if profile is None:
+        pos = mode = mmr = username = None
+    else:
+        pos, mode, mmr, username = profile.position, profile.mode, profile.mmr, profile.username
+    username_line = f"🔗 Username: @{username}\n" if username else ""
+    return (
+        "👤 Твой профиль:\n\n"
+        f"🎯 Позиция: {pos or '—'}\n"
+        f"🎮 Предпочитаемый режим: {mode or '—'}\n"
+        f"📊 MMR: {mmr if mmr is not None else '—'}\n"
+        f"{username_line}{PROFILE_HELP_TEXT}"
+    )
+
+
 # Helper: render previous step in message context (used by go_back and by Cancel from text handlers)
 async def render_prev(prev: Optional[str], update_obj, context: ContextTypes.DEFAULT_TYPE):
     # update_obj may be CallbackQuery or Update (message). We'll use reply/edit appropriately.
@@ -318,65 +589,62 @@ async def render_prev(prev: Optional[str], update_obj, context: ContextTypes.DEF
         else:
             await send(text, reply_markup=reply_markup)
 
-    if not prev:
-        await respond("Главное меню:", reply_markup=get_main_keyboard())
-        return
-
-    if prev == "MAIN_MENU":
-        clear_back(context)
-        await respond("Главное меню:", reply_markup=get_main_keyboard())
-        return
-
-    if prev == "PROFILE":
-        profile = get_profile(from_user_id)
-        online = profile["online"] if profile else False
-        full = profile["full_party"] if profile else False
-        last = get_last_text(context, "PROFILE")
-        text = last or (
-            "👤 Твой профиль:\n\n"
-            f"🎯 Позиция: {profile['position'] if profile else '—'}\n"
-            f"🎮 Предпочитаемый режим: {profile['mode'] if profile else '—'}\n"
-            f"📊 MMR: {profile['mmr'] if profile and profile['mmr'] is not None else '—'}\n"
-            (f"🔗 Username: @{profile['username']}\n" if profile and profile.get("username") else "") +
-            "\n\nСтатус Online/Offline:\n"
-            "Если вы включите Online — вас будут показывать в результатах поиска и вам могут написать.\n"
-            "Если выключите — вы не будете видны в поиске и вас не будут беспокоить."
-        )
-        await respond(text, reply_markup=profile_edit_keyboard_dynamic(online, full))
-        return
+    await PREV_RENDERERS.get(prev, render_main_menu)(respond, context, from_user_id)
 
-    if prev == "SEARCH_MODE":
-        last = get_last_text(context, "SEARCH_MODE")
-        text = last or "Выбери режим игры для поиска:"
-        await respond(text, reply_markup=mode_selection_keyboard(action_prefix="mode_"))
-        return
 
-    if prev == "SEARCH_POS_OPTION":
-        last = get_last_text(context, "SEARCH_POS_OPTION")
-        text = last or "Хотите исключать вашу позицию при поиске, или искать определённую позицию?"
-        await respond(text, reply_markup=search_pos_option_keyboard_dynamic(context.user_data))
-        return
+# Renderers for render_prev: (respond, context, user_id) -> None
 
-    if prev == "SELECT_POSITION":
-        last = get_last_text(context, "SELECT_POSITION")
-        text = last or "Выберите позицию для поиска:"
-        await respond(text, reply_markup=select_position_keyboard())
-        return
 
-    if prev == "SEARCH_FULL_OPTION":
-        last = get_last_text(context, "SEARCH_FULL_OPTION")
-        text = last or "Искать только тех, кто согласен на Full Party?"
-        await respond(text, reply_markup=search_full_option_keyboard())
-        return
+async def render_main_menu(respond, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    await respond("Главное меню:", reply_markup=get_main_keyboard())
 
-    if prev == "SEARCH_MMR":
-        last = get_last_text(context, "SEARCH_MMR")
-        text = last or "Теперь выберите опции по MMR:"
-        await respond(text, reply_markup=search_mmr_keyboard())
-        return
 
-    # fallback
-    await respond("Главное меню:", reply_markup=get_main_keyboard())
+async def render_main_menu_step(respond, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    clear_back(context)
+    await render_main_menu(respond, context, user_id)
+
+
+async def render_profile_step(respond, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    profile = await get_profile(user_id)
+    online = profile.online if profile else False
+    full = profile.full_party if profile else False
+    text = get_last_text(context, "PROFILE") or format_profile_text(profile)
+    await respond(text, reply_markup=profile_edit_keyboard_dynamic(online, full))
+
+
+def last_text_renderer(step: str, default_text: str, keyboard):
+    """Renderer that re-shows the step's stored text (or default_text) with keyboard(context)."""
+    async def render(respond, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+        text = get_last_text(context, step) or default_text
+        await respond(text, reply_markup=keyboard(context))
+    return render
+
+
+# Back-stack step -> renderer; unknown or empty steps fall back to the main menu
+PREV_RENDERERS = {
+    "MAIN_MENU": render_main_menu_step,
+    "PROFILE": render_profile_step,
+    "SEARCH_MODE": last_text_renderer(
+        "SEARCH_MODE", "Выбери режим игры для поиска:",
+        lambda context: mode_selection_keyboard(action_prefix="mode_"),
+    ),
+    "SEARCH_POS_OPTION": last_text_renderer(
+        "SEARCH_POS_OPTION", "Хотите исключать вашу позицию при поиске, или искать определённую позицию?",
+        lambda context: search_pos_option_keyboard_dynamic(search_state(context)),
+    ),
+    "SELECT_POSITION": last_text_renderer(
+        "SELECT_POSITION", "Выберите позицию для поиска:",
+        lambda context: select_position_keyboard(),
+    ),
+    "SEARCH_FULL_OPTION": last_text_renderer(
+        "SEARCH_FULL_OPTION", "Искать только тех, кто согласен на Full Party?",
+        lambda context: search_full_option_keyboard(),
+    ),
+    "SEARCH_MMR": last_text_renderer(
+        "SEARCH_MMR", "Теперь выберите опции по MMR:",
+        lambda context: search_mmr_keyboard(),
+    ),
+}
 
 
 # --- Handlers ---
@@ -408,38 +676,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Main menu
     if data == "main_menu":
         clear_back(context)
-        context.user_data.pop("search_mode", None)
-        context.user_data.pop("exclude_position", None)
-        context.user_data.pop("specific_position", None)
-        context.user_data.pop("only_full_party", None)
-        context.user_data.pop("own_position", None)
+        context.user_data.pop("search", None)
         await query.edit_message_text("Главное меню:", reply_markup=get_main_keyboard())
         return ConversationHandler.END
 
     # Profile view
     if data == "my_profile":
-        profile = get_profile(user_id)
-        pos = profile["position"] if profile else None
-        mode = profile["mode"] if profile else None
-        mmr = profile["mmr"] if profile else None
-        username = profile["username"] if profile else None
-        online = profile["online"] if profile else False
-        full_party = profile["full_party"] if profile else False
-
-        text = "👤 Твой профиль:\n\n"
-        text += f"🎯 Позиция: {pos or '—'}\n"
-        text += f"🎮 Предпочитаемый режим: {mode or '—'}\n"
-        text += f"📊 MMR: {mmr if mmr is not None else '—'}\n"
-        text += f"🔗 Username: @{username}\n" if username else ""
-        text += (
-            "\n\nСтатус Online/Offline:\n"
-            "Если вы включите Online — вас будут показывать в результатах поиска и вам могут написать.\n"
-            "Если выключите — вы не будете видны в поиске и вас не будут беспокоить."
-        )
-        text += (
-            "\n\nFull party (согласен на полную пати):\n"
-            "Если включено — вы помечены как готовый играть в полную пати."
-        )
+        profile = await get_profile(user_id)
+        online = profile.online if profile else False
+        full_party = profile.full_party if profile else False
+        text = format_profile_text(profile)
         # store last text for PROFILE
         store_last_text(context, "PROFILE", text)
         await query.edit_message_text(text=text, reply_markup=profile_edit_keyboard_dynamic(online, full_party))
@@ -447,14 +693,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Toggle online
     if data == "toggle_online":
-        profile = get_profile(user_id) or {}
-        current_online = profile.get("online", False)
+        profile = await get_profile(user_id)
+        current_online = profile.online if profile else False
         new_online = not current_online
         username = query.from_user.username
         try:
-            upsert_profile(user_id=user_id, username=username, online=1 if new_online else 0)
+            profile = await upsert_profile(user_id=user_id, username=username, online=1 if new_online else 0)
         except Exception as e:
-            logger.error(f"Ошибка при переключении online: {e}")
+            logger.error("Ошибка при переключении online: %s", e)
             await query.edit_message_text("Ошибка при переключении статуса. Попробуйте позже.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
 
@@ -470,23 +716,21 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Вы не будете видны в поиске и вас не будут беспокоить люди, ищущие тиммейтов."
             )
 
-        profile = get_profile(user_id)
-        full_party = profile["full_party"] if profile else False
         # store text for PROFILE
         store_last_text(context, "PROFILE", text)
-        await query.edit_message_text(text=text, reply_markup=profile_edit_keyboard_dynamic(new_online, full_party))
+        await query.edit_message_text(text=text, reply_markup=profile_edit_keyboard_dynamic(new_online, profile.full_party))
         return ConversationHandler.END
 
     # Toggle full_party
     if data == "toggle_fullparty":
-        profile = get_profile(user_id) or {}
-        current = profile.get("full_party", False)
+        profile = await get_profile(user_id)
+        current = profile.full_party if profile else False
         new = not current
         username = query.from_user.username
         try:
-            upsert_profile(user_id=user_id, username=username, full_party=1 if new else 0)
+            profile = await upsert_profile(user_id=user_id, username=username, full_party=1 if new else 0)
         except Exception as e:
-            logger.error(f"Ошибка при переключении full_party: {e}")
+            logger.error("Ошибка при переключении full_party: %s", e)
             await query.edit_message_text("Ошибка при переключении опции. Попробуйте позже.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
 
@@ -494,23 +738,35 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = "✅ Вы включили согласие на Full Party.\n\nЭто показывает другим, что вы согласны играть в полную пати."
         else:
             text = "❌ Вы отключили согласие на Full Party.\n\nВы не помечены как желающий играть в полную пати."
-        profile = get_profile(user_id)
-        online = profile["online"] if profile else False
         store_last_text(context, "PROFILE", text)
-        await query.edit_message_text(text=text, reply_markup=profile_edit_keyboard_dynamic(online, new))
+        await query.edit_message_text(text=text, reply_markup=profile_edit_keyboard_dynamic(profile.online, new))
         return ConversationHandler.END
 
     # Edit profile flows
     if data == "edit_position":
         push_back(context, "PROFILE")
-        text = "Укажи свою предпочитаемую позицию цифрой:\n\n1 — Carry\n2 — Mid\n3 — Offlane\n4 — Soft Support\n5 — Hard Support"
+        text = "Выбери свою предпочитаемую позицию (или отправь цифру от 1 до 5):"
         store_last_text(context, "POSITION", text)
+        await query.edit_message_text(text, reply_markup=select_position_keyboard(action_prefix="setpos_"))
+        return POSITION
+
+    # Save position in profile
+    if data.startswith("setpos_"):
+        position_name = position_by_key(data[len("setpos_"):])
+        if position_name is None:
+            await query.edit_message_text("Неверный выбор позиции.", reply_markup=get_main_keyboard())
+            return ConversationHandler.END
+        try:
+            await upsert_profile(user_id=user_id, position=position_name, username=query.from_user.username)
+        except Exception as e:
+            logger.error("Ошибка БД при сохранении позиции: %s", e)
+            await query.edit_message_text("Ошибка сохранения. Попробуй позже.", reply_markup=get_main_keyboard())
+            return ConversationHandler.END
         await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                               InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]])
+            f"✅ Позиция сохранена: {position_name}\n\nТеперь можешь искать тиммейта!",
+            reply_markup=get_main_keyboard()
         )
-        return POSITION
+        return ConversationHandler.END
 
     if data == "edit_mode":
         push_back(context, "PROFILE")
@@ -525,44 +781,35 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         store_last_text(context, "MMR", text)
         await query.edit_message_text(
             text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                              InlineKeyboardButton("🏠 В меню", callback_data="main_menu"),
-                                              InlineKeyboardButton("Отмена", callback_data="go_back")]]),
+            reply_markup=EDIT_MMR_KEYBOARD,
         )
         return MMR
 
     # Save preferred mode in profile
     if data.startswith("setmode_"):
         mode_name = data[len("setmode_"):]
+        if mode_name not in VALID_MODES:
+            await query.edit_message_text("Неверный выбор режима.", reply_markup=get_main_keyboard())
+            return ConversationHandler.END
         username = query.from_user.username
         try:
-            upsert_profile(user_id=user_id, mode=mode_name, username=username)
-            profile = get_profile(user_id)
-            online = profile["online"] if profile else False
-            full_party = profile["full_party"] if profile else False
+            profile = await upsert_profile(user_id=user_id, mode=mode_name, username=username)
             text = f"✅ Предпочитаемый режим сохранён: {mode_name}"
             store_last_text(context, "PROFILE", text)
-            await query.edit_message_text(text, reply_markup=profile_edit_keyboard_dynamic(online, full_party))
+            await query.edit_message_text(text, reply_markup=profile_edit_keyboard_dynamic(profile.online, profile.full_party))
         except Exception as e:
-            logger.error(f"Ошибка при сохранении режима: {e}")
+            logger.error("Ошибка при сохранении режима: %s", e)
             await query.edit_message_text("Ошибка сохранения режима. Попробуйте позже.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
 
     # Start search flow
     if data == "search_party":
-        profile = get_profile(user_id)
-        if not profile or not profile.get("position"):
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("📝 Указать позицию", callback_data="edit_position")],
-                [InlineKeyboardButton("🏠 В меню", callback_data="main_menu")],
-            ])
-            await query.edit_message_text("❌ Сначала укажи позицию в профиле!", reply_markup=keyboard)
+        profile = await get_profile(user_id)
+        if not profile or not profile.position:
+            await query.edit_message_text("❌ Сначала укажи позицию в профиле!", reply_markup=NEED_POSITION_KEYBOARD)
             return ConversationHandler.END
 
-        context.user_data["own_position"] = profile["position"]
-        context.user_data.pop("exclude_position", None)
-        context.user_data.pop("specific_position", None)
-        context.user_data.pop("only_full_party", None)
+        context.user_data["search"] = {"own_position": profile.position}
         clear_back(context)
         push_back(context, "MAIN_MENU")  # Back from SEARCH_MODE should go to main menu
         text = "Выбери режим игры для поиска:"
@@ -576,27 +823,30 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             mode_name = None
         else:
             mode_name = data[len("mode_"):]
-        search_pos = context.user_data.get("own_position")
+            if mode_name not in VALID_MODES:
+                await query.edit_message_text("Неверный выбор режима.", reply_markup=get_main_keyboard())
+                return ConversationHandler.END
+        search_pos = search_state(context).get("own_position")
         if not search_pos:
             await query.edit_message_text("Сначала выберите позицию в профиле.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
 
         push_back(context, "SEARCH_MODE")
-        context.user_data["search_mode"] = mode_name  # can be None
+        search_state(context)["search_mode"] = mode_name  # can be None
         text = "Хотите исключать вашу позицию при поиске, или искать определённую позицию?"
         store_last_text(context, "SEARCH_POS_OPTION", text)
-        await query.edit_message_text(text, reply_markup=search_pos_option_keyboard_dynamic(context.user_data))
+        await query.edit_message_text(text, reply_markup=search_pos_option_keyboard_dynamic(search_state(context)))
         return SEARCH_POS_OPTION
 
     # Compact toggle exclude: now toggle in-place and do NOT advance immediately
     if data == "toggle_exclude_position":
-        cur = context.user_data.get("exclude_position")
-        new = not (cur if cur is not None else True)
-        context.user_data["exclude_position"] = new
+        search = search_state(context)
+        cur = search.get("exclude_position")
+        search["exclude_position"] = not (cur if cur is not None else True)
         # re-render same screen (do not push)
         text = "Выберите действие по позиции для поиска:"
         store_last_text(context, "SEARCH_POS_OPTION", text)
-        await query.edit_message_text(text, reply_markup=search_pos_option_keyboard_dynamic(context.user_data))
+        await query.edit_message_text(text, reply_markup=search_pos_option_keyboard_dynamic(search_state(context)))
         return ConversationHandler.END
 
     # "Start search" from pos options -> go to Full filter step
@@ -616,13 +866,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SELECT_POSITION
 
     if data.startswith("selectpos_"):
-        key = data.split("_", 1)[1]
-        if key not in POSITIONS:
+        pos_name = position_by_key(data[len("selectpos_"):])
+        if pos_name is None:
             await query.edit_message_text("Неверный выбор позиции.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
-        pos_name = POSITIONS[key]
-        context.user_data["specific_position"] = pos_name
-        context.user_data.pop("exclude_position", None)
+        search = search_state(context)
+        search["specific_position"] = pos_name
+        search.pop("exclude_position", None)
         push_back(context, "SELECT_POSITION")
         text_full = "Искать только тех, кто согласен на Full Party?"
         store_last_text(context, "SEARCH_FULL_OPTION", text_full)
@@ -631,7 +881,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Full party options
     if data == "only_full_yes":
-        context.user_data["only_full_party"] = True
+        search_state(context)["only_full_party"] = True
         push_back(context, "SEARCH_FULL_OPTION")
         text = "Выбрано: только Full party. Теперь выберите опции по MMR:"
         store_last_text(context, "SEARCH_MMR", "Теперь выберите опции по MMR:")
@@ -639,7 +889,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SEARCH_MMR
 
     if data == "only_full_no":
-        context.user_data["only_full_party"] = False
+        search_state(context)["only_full_party"] = False
         push_back(context, "SEARCH_FULL_OPTION")
         text = "Выбрано: не фильтровать по Full party. Теперь выберите опции по MMR:"
         store_last_text(context, "SEARCH_MMR", "Теперь выберите опции по MMR:")
@@ -648,51 +898,42 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # MMR options
     if data == "mmr_none":
-        search_mode = context.user_data.get("search_mode")
-        exclude_pos = context.user_data.get("exclude_position")
-        specific_pos = context.user_data.get("specific_position")
-        only_full = context.user_data.get("only_full_party")
+        search = search_state(context)
+        search_mode = search.get("search_mode")
+        exclude_pos = search.get("exclude_position")
+        specific_pos = search.get("specific_position")
+        only_full = search.get("only_full_party")
         await perform_search_and_reply(query, user_id, search_mode, mmr_filter=None, exclude_position=exclude_pos, specific_position=specific_pos, only_full_party=only_full)
         # clear search temp data and back stack
-        context.user_data.pop("search_mode", None)
-        context.user_data.pop("exclude_position", None)
-        context.user_data.pop("specific_position", None)
-        context.user_data.pop("only_full_party", None)
-        context.user_data.pop("own_position", None)
+        context.user_data.pop("search", None)
         clear_back(context)
         return ConversationHandler.END
 
+    if data == "delta_custom":
+        push_back(context, "SEARCH_MMR")
+        text = "Введи значение Δ (положительное целое), например: 300\n(ММР будет искаться в диапазоне [your_mmr - Δ, your_mmr + Δ])"
+        store_last_text(context, "SEARCH_MMR", text)
+        await query.edit_message_text(text, reply_markup=BACK_MENU_KEYBOARD)
+        return SEARCH_MMR
+
     if data.startswith("delta_"):
         delta = int(data.split("_", 1)[1])
-        profile = get_profile(user_id)
-        user_mmr = profile.get("mmr") if profile else None
+        profile = await get_profile(user_id)
+        user_mmr = profile.mmr if profile else None
         if user_mmr is None:
-            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📝 Указать MMR", callback_data="edit_mmr")],
-                                            [InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]])
-            await query.edit_message_text("Чтобы фильтровать по MMR, сначала укажи свой MMR.", reply_markup=keyboard)
+            await query.edit_message_text("Чтобы фильтровать по MMR, сначала укажи свой MMR.", reply_markup=NEED_MMR_KEYBOARD)
             return ConversationHandler.END
 
-        search_mode = context.user_data.get("search_mode")
-        exclude_pos = context.user_data.get("exclude_position")
-        specific_pos = context.user_data.get("specific_position")
-        only_full = context.user_data.get("only_full_party")
+        search = search_state(context)
+        search_mode = search.get("search_mode")
+        exclude_pos = search.get("exclude_position")
+        specific_pos = search.get("specific_position")
+        only_full = search.get("only_full_party")
         await perform_search_and_reply(query, user_id, search_mode, mmr_filter=delta, exclude_position=exclude_pos, specific_position=specific_pos, only_full_party=only_full)
-        context.user_data.pop("search_mode", None)
-        context.user_data.pop("exclude_position", None)
-        context.user_data.pop("specific_position", None)
-        context.user_data.pop("only_full_party", None)
-        context.user_data.pop("own_position", None)
+        context.user_data.pop("search", None)
         clear_back(context)
         return ConversationHandler.END
 
-    if data == "delta_custom":
-        push_back(context, "SEARCH_MMR")
-        text = "Введи значение Δ (положительное целое), например: 300\n(ММР будет искаться в диапазоне [your_mmr - Δ, your_mmr + Δ])"
-        store_last_text(context, "SEARCH_MMR", text)
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                                                                InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]]))
-        return SEARCH_MMR
-
     return ConversationHandler.END
 
 
@@ -709,21 +950,19 @@ async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_prev(prev, update, context)
         return ConversationHandler.END
 
-    pos_key = txt
-    if pos_key not in POSITIONS:
+    position_name = position_by_key(txt)
+    if position_name is None:
         await update.message.reply_text(
             "❌ Введи цифру от 1 до 5!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                               InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]]),
+            reply_markup=BACK_MENU_KEYBOARD,
         )
         return POSITION
-    position_name = POSITIONS[pos_key]
     user_id = update.message.from_user.id
     username = update.message.from_user.username
     try:
-        upsert_profile(user_id=user_id, position=position_name, username=username)
+        await upsert_profile(user_id=user_id, position=position_name, username=username)
     except Exception as e:
-        logger.error(f"Ошибка БД при сохранении позиции: {e}")
+        logger.error("Ошибка БД при сохранении позиции: %s", e)
         await update.message.reply_text("Ошибка сохранения. Попробуй позже.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     await update.message.reply_text(
@@ -742,24 +981,19 @@ async def get_mmr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         prev = pop_back(context)
         await render_prev(prev, update, context)
         return ConversationHandler.END
-    try:
-        mmr = int(txt)
-        if mmr < 0 or mmr > 15000:
-            raise ValueError
-    except ValueError:
+    # isdecimal() rejects signs, spaces and superscripts up front, so int() never raises
+    if not (txt.isdecimal() and len(txt) <= 5 and (mmr := int(txt)) <= MMR_MAX):
         await update.message.reply_text(
-            "❌ Введи корректное число MMR (от 0 до 15000)!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                               InlineKeyboardButton("🏠 В меню", callback_data="main_menu"),
-                                               InlineKeyboardButton("Отмена", callback_data="go_back")]]),
+            f"❌ Введи корректное число MMR (от 0 до {MMR_MAX})!",
+            reply_markup=EDIT_MMR_KEYBOARD,
         )
         return MMR
     user_id = update.message.from_user.id
     username = update.message.from_user.username
     try:
-        upsert_profile(user_id=user_id, mmr=mmr, username=username)
+        await upsert_profile(user_id=user_id, mmr=mmr, username=username)
     except Exception as e:
-        logger.error(f"Ошибка БД при сохранении MMR: {e}")
+        logger.error("Ошибка БД при сохранении MMR: %s", e)
         await update.message.reply_text("Ошибка сохранения. Попробуй позже.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     await update.message.reply_text("✅ MMR сохранён.", reply_markup=get_main_keyboard())
@@ -775,31 +1009,26 @@ async def get_search_mmr_custom(update: Update, context: ContextTypes.DEFAULT_TY
         prev = pop_back(context)
         await render_prev(prev, update, context)
         return ConversationHandler.END
-    try:
-        delta = int(txt)
-        if delta <= 0:
-            raise ValueError
-    except ValueError:
+    # same up-front check as get_mmr; a Δ over five digits adds nothing, the range is clamped to MMR_MAX
+    if not (txt.isdecimal() and len(txt) <= 5 and (delta := int(txt)) > 0):
         await update.message.reply_text(
             "❌ Введи корректное положительное число Δ (например: 300).",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="go_back"),
-                                               InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]]),
+            reply_markup=BACK_MENU_KEYBOARD,
         )
         return SEARCH_MMR
 
     user_id = update.message.from_user.id
-    profile = get_profile(user_id)
-    user_mmr = profile.get("mmr") if profile else None
+    profile = await get_profile(user_id)
+    user_mmr = profile.mmr if profile else None
     if user_mmr is None:
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📝 Указать MMR", callback_data="edit_mmr")],
-                                        [InlineKeyboardButton("🏠 В меню", callback_data="main_menu")]])
-        await update.message.reply_text("Чтобы фильтровать по MMR, сначала укажи свой MMR.", reply_markup=keyboard)
+        await update.message.reply_text("Чтобы фильтровать по MMR, сначала укажи свой MMR.", reply_markup=NEED_MMR_KEYBOARD)
         return ConversationHandler.END
 
-    search_mode = context.user_data.get("search_mode")
-    exclude_pos = context.user_data.get("exclude_position")
-    specific_pos = context.user_data.get("specific_position")
-    only_full = context.user_data.get("only_full_party")
+    search = search_state(context)
+    search_mode = search.get("search_mode")
+    exclude_pos = search.get("exclude_position")
+    specific_pos = search.get("specific_position")
+    only_full = search.get("only_full_party")
 
     class DummyQuery:
         def __init__(self, update):
@@ -810,11 +1039,7 @@ async def get_search_mmr_custom(update: Update, context: ContextTypes.DEFAULT_TY
 
     dummy = DummyQuery(update)
     await perform_search_and_reply(dummy, user_id, search_mode, mmr_filter=delta, exclude_position=exclude_pos, specific_position=specific_pos, only_full_party=only_full)
-    context.user_data.pop("search_mode", None)
-    context.user_data.pop("exclude_position", None)
-    context.user_data.pop("specific_position", None)
-    context.user_data.pop("only_full_party", None)
-    context.user_data.pop("own_position", None)
+    context.user_data.pop("search", None)
     clear_back(context)
     return ConversationHandler.END
 
@@ -822,6 +1047,47 @@ async def get_search_mmr_custom(update: Update, context: ContextTypes.DEFAULT_TY
 # --- Search execution ---
 
 
+# One result entry: label, position, mode, MMR, full-party mark
+SEARCH_RESULT_LINE = "👤 {0}\n🎯 {1} | 🎮 {2} | 📊 {3} | {4}"
+SEARCH_NOT_FOUND_TEXT = "😔 Пока никто не найден по заданным критериям. Попробуй позже!"
+
+
+@lru_cache(maxsize=None)
+def search_sql(position_filter: Optional[str], by_mode: bool, only_full_party: bool, by_mmr: bool) -> str:
+    """
+    Search SQL for one combination of filters, built once per combination so
+    repeated searches pass identical text to the prepared statement cache.
+    position_filter: "specific", "exclude" or None.
+    Named parameters: requester_id, position, mode, mmr_min, mmr_max, mmr.
+    """
+    # Only include online users
+    sql = "SELECT user_id, position, mode, mmr, username, full_party FROM profiles WHERE user_id != :requester_id AND online = 1"
+    if position_filter == "specific":
+        sql += " AND position = :position"
+    elif position_filter == "exclude":
+        sql += " AND (position IS NULL OR position != :position)"
+    if by_mode:
+        sql += " AND mode = :mode"
+    if only_full_party:
+        sql += " AND full_party = 1"
+    if not by_mmr:
+        # no ORDER BY, so the index scan stops at the 30th match
+        return sql + " LIMIT 30"
+    # Closest MMR first, as two halves read upwards and downwards from the
+    # requester's MMR, LIMIT 30 each; only those <= 60 rows get the final sort.
+    # A half stops early only if its index yields rows in mmr order: that is
+    # idx_profiles_online_mmr, or idx_profiles_online_position when position,
+    # mode and full_party are all pinned. With the stats open_db() collects the
+    # planner picks one of those for every shape; without stats, mode= and
+    # position= shapes use their own index and sort the whole range.
+    return (
+        "SELECT * FROM ("
+        f"SELECT * FROM ({sql} AND mmr BETWEEN :mmr AND :mmr_max ORDER BY mmr LIMIT 30) UNION ALL "
+        f"SELECT * FROM ({sql} AND mmr BETWEEN :mmr_min AND :mmr - 1 ORDER BY mmr DESC LIMIT 30)"
+        ") ORDER BY ABS(mmr - :mmr) LIMIT 30"
+    )
+
+
 async def perform_search_and_reply(
     query_obj,
     requester_id: int,
@@ -844,54 +1110,44 @@ async def perform_search_and_reply(
       - ИСКЛЮЧИТЕЛЬНО возвращаем только тех, у кого online = 1
     """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        requester_profile = await get_profile(requester_id)
+        requester_pos = requester_profile.position if requester_profile else None
+        requester_mmr = requester_profile.mmr if requester_profile else None
 
-        requester_profile = get_profile(requester_id)
-        requester_pos = requester_profile.get("position") if requester_profile else None
-        requester_mmr = requester_profile.get("mmr") if requester_profile else None
-
-        params = [requester_id]
-        # Only include online users
-        sql = "SELECT user_id, position, mode, mmr, username, full_party FROM profiles WHERE user_id != ? AND online = 1"
+        params = {"requester_id": requester_id}
 
         # Position filtering
+        position_filter = None
         if specific_position:
-            sql += " AND position = ?"
-            params.append(specific_position)
+            position_filter = "specific"
+            params["position"] = POSITION_CODES.get(specific_position)
         else:
             if exclude_position is True and requester_pos:
-                sql += " AND (position IS NULL OR position != ?)"
-                params.append(requester_pos)
+                position_filter = "exclude"
+                params["position"] = POSITION_CODES.get(requester_pos)
 
         # Mode logic: strict if search_mode provided
         if search_mode:
-            sql += " AND LOWER(mode) = LOWER(?)"
-            params.append(search_mode)
-
-        # Full party filter
-        if only_full_party:
-            sql += " AND full_party = 1"
+            params["mode"] = MODE_CODES.get(search_mode)
 
         # MMR filtering
         if mmr_filter is not None:
             if requester_mmr is None:
                 await query_obj.edit_message_text("Чтобы фильтровать по MMR, у тебя должен быть указан MMR в профиле.", reply_markup=get_main_keyboard())
-                conn.close()
                 return
-            min_m = max(0, requester_mmr - mmr_filter)
-            max_m = requester_mmr + mmr_filter
-            sql += " AND mmr BETWEEN ? AND ?"
-            params.extend([min_m, max_m])
-
-        sql += " LIMIT 30"
-
-        logger.info("Выполняю SQL: %s | params=%s", sql, params)
-        cursor.execute(sql, tuple(params))
-        rows = cursor.fetchall()
+            params["mmr_min"] = max(0, requester_mmr - mmr_filter)
+            params["mmr_max"] = min(MMR_MAX, requester_mmr + mmr_filter)
+            params["mmr"] = requester_mmr
+
+        sql = search_sql(position_filter, bool(search_mode), bool(only_full_party), mmr_filter is not None)
+
+        key = (sql, *params.values())
+        rows = get_cached_search(key)
+        if rows is None:
+            logger.info("Выполняю SQL: %s | params=%s", sql, params)
+            rows = await DB.execute_fetchall(sql, params)
+            cache_search(key, rows)
         logger.info("Найдено строк: %d", len(rows))
-
-        conn.close()
     except Exception:
         logger.exception("Ошибка при выполнении поиска в БД")
         try:
@@ -902,37 +1158,51 @@ async def perform_search_and_reply(
 
     if not rows:
         try:
-            await query_obj.edit_message_text("😔 Пока никто не найден по заданным критериям. Попробуй позже!", reply_markup=get_main_keyboard())
+            await query_obj.edit_message_text(SEARCH_NOT_FOUND_TEXT, reply_markup=get_main_keyboard())
         except Exception:
             logger.exception("Не удалось отправить сообщение 'нет результатов'")
         return
+    await send_search_results(query_obj, rows)
+
+
+async def send_search_results(query_obj, rows):
+    """Render non-empty search rows as one message with a contact button per player."""
+    # Build combined text and buttons; header and footer go in the same list
+    # so the message is assembled by a single join
+    labels = [f"@{username}" if username else f"ID {uid}" for uid, _, _, _, username, _ in rows]
+    combined_lines = ["Результаты поиска:"]
+    combined_lines += [
+        SEARCH_RESULT_LINE.format(
+            label,
+            POSITION_NAMES.get(pos, "—"),
+            MODE_NAMES.get(mode, "—"),
+            user_mmr if user_mmr is not None else "—",
+            "✅ Full" if full_party else "—",
+        )
+        for label, (_, pos, mode, user_mmr, _, full_party) in zip(labels, rows)
+    ]
+    buttons = [
+        [InlineKeyboardButton(f"Написать {label}", url=f"https://t.me/{username}" if username else f"tg://user?id={uid}")]
+        for label, (uid, _, _, _, username, _) in zip(labels, rows)
+    ]
 
-    # Build combined text and buttons
-    combined_lines = []
-    buttons = []
-    for uid, pos, mode, user_mmr, username, full_party in rows:
-        label = f"@{username}" if username else f"ID {uid}"
-        fp_text = "✅ Full" if full_party else "—"
-        combined_lines.append(f"👤 {label}\n🎯 {pos or '—'} | 🎮 {mode or '—'} | 📊 {user_mmr if user_mmr is not None else '—'} | {fp_text}")
-        if username:
-            buttons.append([InlineKeyboardButton(f"Написать {label}", url=f"https://t.me/{username}")])
-        else:
-            buttons.append([InlineKeyboardButton(f"Написать {label}", url=f"tg://user?id={uid}")])
-
-    # add menu button row
+    # add menu button row; SQL LIMIT 30 already caps the contact rows, so it is never cut off
     buttons.append([InlineKeyboardButton("🏠 В меню", callback_data="main_menu")])
 
-    combined_text = "Результаты поиска:\n\n" + "\n\n".join(combined_lines) + "\n\nНапиши игрокам, чтобы договориться о игре!"
+    combined_lines.append("Напиши игрокам, чтобы договориться о игре!")
+    combined_text = "\n\n".join(combined_lines)
+    # built once, shared by the edit and the fallback reply
+    reply_markup = InlineKeyboardMarkup(buttons)
     try:
-        await query_obj.edit_message_text(text=combined_text, reply_markup=InlineKeyboardMarkup(buttons[:30]))
+        await query_obj.edit_message_text(text=combined_text, reply_markup=reply_markup)
     except Exception:
         logger.exception("Не удалось отправить результаты поиска через edit_message_text")
         try:
             # fallback for DummyQuery
             if hasattr(query_obj, "_update") and getattr(query_obj._update, "message", None):
-                await query_obj._update.message.reply_text(text=combined_text, reply_markup=InlineKeyboardMarkup(buttons[:30]))
+                await query_obj._update.message.reply_text(text=combined_text, reply_markup=reply_markup)
             elif getattr(query_obj, "message", None):
-                await query_obj.message.reply_text(text=combined_text, reply_markup=InlineKeyboardMarkup(buttons[:30]))
+                await query_obj.message.reply_text(text=combined_text, reply_markup=reply_markup)
         except Exception:
             logger.exception("Fallback отправки сообщения результатов не удался")
 
@@ -948,18 +1218,26 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
     # Вставьте сюда ваш токен
     token = "YOUR_BOT_TOKEN_HERE"
 
     if token == "YOUR_BOT_TOKEN_HERE":
         logger.warning("BOT_TOKEN не установлен. Замените 'YOUR_BOT_TOKEN_HERE' на реальный токен.")
 
-    application = Application.builder().token(token).build()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    application = Application.builder().token(token).post_init(open_db).post_shutdown(close_db).build()
 
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(button_handler)],
         states={
-            POSITION: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_position)],
+            POSITION: [
+                CallbackQueryHandler(button_handler),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_position),
+            ],
             MODE: [CallbackQueryHandler(button_handler)],
             MMR: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_mmr)],
             SEARCH_MODE: [CallbackQueryHandler(button_handler)],